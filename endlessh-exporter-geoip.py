@@ -4,241 +4,447 @@ Endlessh Prometheus Exporter with GeoIP
 Parses journalctl logs from endlessh and exports metrics for Prometheus with geographic data
 """
 
-import re
 import subprocess
 import json
+import heapq
 import os
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from collections import defaultdict
-from datetime import datetime, timezone
+import queue
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import defaultdict, OrderedDict
+from datetime import datetime
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
 
 # Port for Prometheus scraping
 EXPORTER_PORT = 9314
 
+# Seconds between log parses (scrapes in between get the cached metrics)
+METRICS_REFRESH_INTERVAL = 15
+
 # Persistent storage for Hall of Fame
 HALL_OF_FAME_FILE = '/data/hall_of_fame.json'
+HALL_OF_FAME_SIZE = 100  # Longest released connections kept (one per IP)
+
+# Local MaxMind GeoLite2 City database (used instead of ip-api.com if present)
+GEOIP_DATABASE_FILE = '/data/GeoLite2-City.mmdb'
+
+# GeoIP cache limits
+GEOIP_CACHE_SIZE = 100000  # Max cached IPs (least recently used are evicted first)
+GEOIP_RETRY_INTERVAL = 24 * 3600  # Seconds before an IP without GeoIP data is looked up again
+GEOIP_API_INTERVAL = 60 / 45  # Seconds between ip-api.com requests (free tier: 45 requests/minute)
+
+# Fallback location for IPs without (successful) GeoIP lookup
+UNKNOWN_LOCATION = {
+    'country': 'Unknown',
+    'country_code': 'XX',
+    'city': 'Unknown',
+    'lat': 0.0,
+    'lon': 0.0
+}
+
+# Static HELP/TYPE lines of the exported metrics
+HELP_TOTAL_CONNECTIONS_TOTAL = (
+    b'# HELP endlessh_total_connections_total Total SSH connections since exporter start\n'
+    b'# TYPE endlessh_total_connections_total counter'
+)
+HELP_TOTAL_CONNECTIONS = (
+    b'# HELP endlessh_total_connections Total SSH connections in last 60 minutes\n'
+    b'# TYPE endlessh_total_connections gauge'
+)
+HELP_ACTIVE_CONNECTIONS = (
+    b'# HELP endlessh_active_connections Currently active SSH connections\n'
+    b'# TYPE endlessh_active_connections gauge'
+)
+HELP_MAX_TRAP_DURATION_SECONDS = (
+    b'# HELP endlessh_max_trap_duration_seconds Maximum trap duration in seconds\n'
+    b'# TYPE endlessh_max_trap_duration_seconds gauge'
+)
+HELP_AVG_TRAP_DURATION_SECONDS = (
+    b'# HELP endlessh_avg_trap_duration_seconds Average trap duration in seconds\n'
+    b'# TYPE endlessh_avg_trap_duration_seconds gauge'
+)
+HELP_CONNECTION_INFO = (
+    b'# HELP endlessh_connection_info Individual connection information\n'
+    b'# TYPE endlessh_connection_info gauge'
+)
 
 # Store metrics
-individual_connections = {}  # conn_id -> {ip, started, duration, status, country, city}
+individual_connections = {}  # conn_id -> {ip, started_ts, duration, status, country, city}
 hall_of_fame = {}  # Persistent storage for released connections (Top 100 by duration)
-ip_locations = {}  # IP -> {country, lat, lon}
+hall_of_fame_heap = []  # (duration, conn_id) min-heap over hall_of_fame, shortest entry first
+hall_of_fame_by_ip = {}  # IP -> conn_id of its (only) Hall of Fame entry
+hall_of_fame_dirty = False  # Hall of Fame changed since it was last written to disk
+ip_locations = OrderedDict()  # IP -> {country, lat, lon} (LRU order, bounded by GEOIP_CACHE_SIZE)
+geoip_failures = {}  # IP -> time of last lookup without GeoIP data (negative cache)
+geoip_reader = None  # Open MaxMind database reader (None = use ip-api.com)
+geoip_queue = queue.Queue()  # IPs waiting for a background GeoIP lookup
+geoip_pending = set()  # IPs currently in geoip_queue (avoids queueing an IP twice)
+geoip_lock = threading.Lock()  # Guards ip_locations, geoip_failures and geoip_pending
 total_connections_counter = 0  # Counter: total connections since start (never reset)
-seen_log_entries = set()  # Track which log entries we've already counted
+seen_log_entries = {}  # log_id -> started_ts of log entries we've already counted (last 5 minutes)
 connections_per_ip = defaultdict(int)  # IP -> count (for aggregated stats)
 max_trap_duration = 0  # Max trap duration in seconds (from currently displayed connections)
 avg_trap_duration = 0  # Average trap duration in seconds
 active_connections = 0  # Currently active connections
+ip_trap_durations = {}  # IP -> [max, total, count] trap duration of displayed connections
+metrics_cache = b''  # Last rendered metrics, served to every scrape
+metrics_lock = threading.Lock()  # Guards metrics_cache
+
+def add_to_hall_of_fame(conn_id, conn):
+    """Offer a released connection to the Hall of Fame, returns True if it changed"""
+    ip = conn['ip']
+    duration = conn['duration']
+
+    # Deduplicated per IP: only the longest connection of each IP is kept
+    existing_id = hall_of_fame_by_ip.get(ip)
+    if existing_id is not None:
+        existing = hall_of_fame[existing_id]
+        if existing_id == conn_id and duration <= existing['duration']:
+            # Same connection seen again: pick up a GeoIP location resolved in the meantime
+            if existing['country_code'] == 'XX' and conn['country_code'] != 'XX':
+                existing.update(country=conn['country'], city=conn['city'], country_code=conn['country_code'])
+                return True
+            return False
+        if duration <= existing['duration']:
+            return False
+
+        # Replace the IP's entry (endlessh may reuse ip:port for a later, longer connection);
+        # this is rare, so simply rebuild the (small) heap
+        del hall_of_fame[existing_id]
+        hall_of_fame[conn_id] = conn
+        hall_of_fame_by_ip[ip] = conn_id
+        hall_of_fame_heap[:] = [(c['duration'], cid) for cid, c in hall_of_fame.items()]
+        heapq.heapify(hall_of_fame_heap)
+        return True
+
+    if len(hall_of_fame_heap) < HALL_OF_FAME_SIZE:
+        heapq.heappush(hall_of_fame_heap, (duration, conn_id))
+    elif duration > hall_of_fame_heap[0][0]:
+        # Push out the shortest entry
+        _, evicted_id = heapq.heapreplace(hall_of_fame_heap, (duration, conn_id))
+        del hall_of_fame_by_ip[hall_of_fame.pop(evicted_id)['ip']]
+    else:
+        return False
+
+    hall_of_fame[conn_id] = conn
+    hall_of_fame_by_ip[ip] = conn_id
+    return True
 
 def load_hall_of_fame():
     """Load Hall of Fame from JSON file if it exists"""
-    global hall_of_fame
+    global hall_of_fame_dirty
+
+    hall_of_fame.clear()
+    hall_of_fame_heap.clear()
+    hall_of_fame_by_ip.clear()
 
     if os.path.exists(HALL_OF_FAME_FILE):
         try:
             with open(HALL_OF_FAME_FILE, 'r') as f:
                 data = json.load(f)
-                # Convert datetime strings back to datetime objects
+                # Convert ISO timestamps from older files to POSIX timestamps
                 for conn_id, conn in data.items():
                     if 'started' in conn and isinstance(conn['started'], str):
-                        # Parse ISO format timestamp
-                        conn['started'] = datetime.fromisoformat(conn['started'])
-                hall_of_fame = data
+                        conn['started_ts'] = datetime.fromisoformat(conn.pop('started')).timestamp()
+                        hall_of_fame_dirty = True
+                    add_to_hall_of_fame(conn_id, conn)
+                # Rewrite files that held duplicates or more than HALL_OF_FAME_SIZE entries
+                if len(hall_of_fame) != len(data):
+                    hall_of_fame_dirty = True
                 print(f"Loaded {len(hall_of_fame)} connections from Hall of Fame")
         except Exception as e:
             print(f"Error loading Hall of Fame: {e}")
-            hall_of_fame = {}
+            hall_of_fame.clear()
+            hall_of_fame_heap.clear()
+            hall_of_fame_by_ip.clear()
     else:
         print("No existing Hall of Fame found, starting fresh")
-        hall_of_fame = {}
 
 def save_hall_of_fame():
-    """Save Hall of Fame to JSON file"""
+    """Save Hall of Fame to JSON file (only if it changed since the last save)"""
+    global hall_of_fame_dirty
+
+    if not hall_of_fame_dirty:
+        return
+
     try:
         # Create directory if it doesn't exist
         os.makedirs(os.path.dirname(HALL_OF_FAME_FILE), exist_ok=True)
 
-        # Convert datetime objects to ISO strings for JSON serialization
-        data_to_save = {}
-        for conn_id, conn in hall_of_fame.items():
-            conn_copy = conn.copy()
-            if 'started' in conn_copy and isinstance(conn_copy['started'], datetime):
-                conn_copy['started'] = conn_copy['started'].isoformat()
-            data_to_save[conn_id] = conn_copy
-
-        # Write to file
-        with open(HALL_OF_FAME_FILE, 'w') as f:
-            json.dump(data_to_save, f, indent=2)
+        # Write to a temporary file and swap it in, so a crash never leaves a truncated file
+        tmp_file = HALL_OF_FAME_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(hall_of_fame, f, separators=(',', ':'))
+        os.replace(tmp_file, HALL_OF_FAME_FILE)
+        hall_of_fame_dirty = False
 
     except Exception as e:
         print(f"Error saving Hall of Fame: {e}")
 
-def get_geoip_data(ip):
-    """Get GeoIP data using geoiplookup or online API"""
-    if ip in ip_locations:
-        return ip_locations[ip]
+def open_geoip_database():
+    """Open the local MaxMind GeoLite2 database if it is available"""
+    global geoip_reader
+
+    if maxminddb is None:
+        print("maxminddb not installed, using ip-api.com for GeoIP lookups")
+        return
+    if not os.path.exists(GEOIP_DATABASE_FILE):
+        print(f"No GeoIP database at {GEOIP_DATABASE_FILE}, using ip-api.com for GeoIP lookups")
+        return
 
-    # Try using a simple HTTP API (ip-api.com allows 45 requests/minute for free)
     try:
-        import urllib.request
-        url = f"http://ip-api.com/json/{ip}?fields=status,country,countryCode,lat,lon,city"
-        with urllib.request.urlopen(url, timeout=2) as response:
-            data = json.loads(response.read().decode())
-            if data.get('status') == 'success':
-                result = {
-                    'country': data.get('country', 'Unknown'),
-                    'country_code': data.get('countryCode', 'XX'),
-                    'city': data.get('city', 'Unknown'),
-                    'lat': data.get('lat', 0.0),
-                    'lon': data.get('lon', 0.0)
-                }
-                ip_locations[ip] = result
-                return result
+        geoip_reader = maxminddb.open_database(GEOIP_DATABASE_FILE, maxminddb.MODE_AUTO)
+        print(f"Using local GeoIP database {GEOIP_DATABASE_FILE}")
     except Exception as e:
-        pass
+        print(f"Error opening GeoIP database: {e}")
+        geoip_reader = None
 
-    # Fallback
+def lookup_geoip_database(ip):
+    """Look up an IP in the local MaxMind database (None if unknown)"""
+    record = geoip_reader.get(ip)
+    if not record:
+        return None
+
+    country = record.get('country', {})
+    location = record.get('location', {})
     return {
-        'country': 'Unknown',
-        'country_code': 'XX',
-        'city': 'Unknown',
-        'lat': 0.0,
-        'lon': 0.0
+        'country': country.get('names', {}).get('en', 'Unknown'),
+        'country_code': country.get('iso_code', 'XX'),
+        'city': record.get('city', {}).get('names', {}).get('en', 'Unknown'),
+        'lat': location.get('latitude', 0.0),
+        'lon': location.get('longitude', 0.0)
     }
 
+def lookup_geoip_api(ip):
+    """Look up an IP using ip-api.com (None if the lookup failed)"""
+    # ip-api.com allows 45 requests/minute for free (see GEOIP_API_INTERVAL)
+    import urllib.request
+    url = f"http://ip-api.com/json/{ip}?fields=status,country,countryCode,lat,lon,city"
+    with urllib.request.urlopen(url, timeout=2) as response:
+        data = json.loads(response.read().decode())
+    if data.get('status') != 'success':
+        return None
+
+    return {
+        'country': data.get('country', 'Unknown'),
+        'country_code': data.get('countryCode', 'XX'),
+        'city': data.get('city', 'Unknown'),
+        'lat': data.get('lat', 0.0),
+        'lon': data.get('lon', 0.0)
+    }
+
+def sanitize_label_value(value):
+    """Make a string safe to use as a Prometheus label value"""
+    return str(value).replace('"', '').replace('\\', '\\\\').replace('\n', '\\n')
+
+def get_geoip_data(ip):
+    """Get cached GeoIP data, queueing a background lookup for IPs not resolved yet"""
+    with geoip_lock:
+        if ip in ip_locations:
+            ip_locations.move_to_end(ip)
+            return ip_locations[ip]
+
+        # Already queued, or recently found to have no GeoIP data: don't look it up again
+        if ip in geoip_pending:
+            return UNKNOWN_LOCATION
+        failed_at = geoip_failures.get(ip)
+        if failed_at is not None and time.time() - failed_at < GEOIP_RETRY_INTERVAL:
+            return UNKNOWN_LOCATION
+
+        geoip_pending.add(ip)
+
+    geoip_queue.put_nowait(ip)
+
+    # Fallback until the lookup is done
+    return UNKNOWN_LOCATION
+
+def resolve_geoip_data(ip):
+    """Look up an IP in the local MaxMind database or the online API and cache the result"""
+    try:
+        if geoip_reader is not None:
+            result = lookup_geoip_database(ip)
+        else:
+            result = lookup_geoip_api(ip)
+    except Exception as e:
+        # Rate limits, timeouts and DNS errors are temporary: retry on a later parse
+        with geoip_lock:
+            geoip_pending.discard(ip)
+        return
+
+    if result is not None:
+        # Sanitize once here instead of on every emitted metric
+        for key in ('country', 'country_code', 'city'):
+            result[key] = sanitize_label_value(result[key])
+
+    with geoip_lock:
+        geoip_pending.discard(ip)
+
+        if result is not None:
+            ip_locations[ip] = result
+            geoip_failures.pop(ip, None)
+            if len(ip_locations) > GEOIP_CACHE_SIZE:
+                ip_locations.popitem(last=False)
+            return
+
+        # Remember the negative answer (re-inserted so the oldest failure is evicted first)
+        geoip_failures.pop(ip, None)
+        geoip_failures[ip] = time.time()
+        if len(geoip_failures) > GEOIP_CACHE_SIZE:
+            del geoip_failures[next(iter(geoip_failures))]
+
+def geoip_worker():
+    """Resolve queued IPs in the background, so scrapes never wait for a lookup"""
+    while True:
+        resolve_geoip_data(geoip_queue.get())
+        # Stay below the ip-api.com rate limit (the local database needs no pacing)
+        if geoip_reader is None:
+            time.sleep(GEOIP_API_INTERVAL)
+
+def parse_endlessh_message(message):
+    """Split an endlessh log message into its event name and key=value fields"""
+    # 2025-10-14T16:17:13.280Z ACCEPT host=::ffff:1.2.3.4 port=40812 fd=4 n=1/4096
+    # 2025-10-14T16:17:33.283Z CLOSE host=::ffff:1.2.3.4 port=40812 fd=4 time=20.003 bytes=1234
+    tokens = message.split()
+    # Skip endlessh's own timestamp, journald already provides one
+    if tokens and tokens[0].endswith('Z'):
+        tokens = tokens[1:]
+    if not tokens or tokens[0] not in ('ACCEPT', 'CLOSE'):
+        return None, None
+
+    fields = {}
+    for token in tokens[1:]:
+        key, _, value = token.partition('=')
+        fields[key] = value
+    return tokens[0], fields
+
+def read_journal_lines(since):
+    """Stream endlessh journal entries (one JSON object per line) while journalctl is still reading them"""
+    # Only MESSAGE is requested; __REALTIME_TIMESTAMP and the other __ fields are always included
+    cmd = ['journalctl', '-u', 'endlessh', '--since', since, '--no-pager', '-o', 'json', '--output-fields=MESSAGE']
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, bufsize=1 << 20) as proc:
+        yield from proc.stdout
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
 def parse_endlessh_logs():
     """Parse endlessh logs from journalctl"""
-    global individual_connections, hall_of_fame, active_connections, connections_per_ip
+    global individual_connections, hall_of_fame_dirty, active_connections, connections_per_ip
     global total_connections_counter, seen_log_entries
-    global max_trap_duration, avg_trap_duration
+    global max_trap_duration, avg_trap_duration, ip_trap_durations
+
+    # Rebuild current connections from logs + hall of fame.
+    # Parse into fresh containers and only publish them once journalctl succeeded.
+    connections = {}
+    ip_counts = defaultdict(int)
+    released = {}
+    # Connections accepted within the last 5 minutes are added to the counter
+    counter_cutoff_ts = time.time() - 5 * 60
 
     # Get logs from last 6 hours (to catch long-running traps)
     # Note: Hall of Fame persists released connections, so we don't lose history
-    cmd_6h = ['journalctl', '-u', 'endlessh', '--since', '6 hours ago', '--no-pager']
+    # Events are parsed chronologically while journalctl streams them:
+    # an ACCEPT opens a trapped connection, the matching CLOSE later releases it.
     try:
-        output_6h = subprocess.check_output(cmd_6h, text=True)
-    except subprocess.CalledProcessError:
-        return
-
-    # Get logs from last 5 minutes (for new connections to add to counter)
-    cmd_5min = ['journalctl', '-u', 'endlessh', '--since', '5 minutes ago', '--no-pager']
-    try:
-        output_5min = subprocess.check_output(cmd_5min, text=True)
-    except subprocess.CalledProcessError:
-        output_5min = ""
-
-    # Reset current connections (will rebuild from logs + hall of fame)
-    individual_connections.clear()
-    connections_per_ip.clear()
-    current_active = 0
-    current_time = datetime.now(timezone.utc)
-
-    # Parse patterns - use port as unique connection ID (port is unique, fd gets reused)
-    accept_pattern = r'ACCEPT host=::ffff:(\d+\.\d+\.\d+\.\d+) port=(\d+).*?fd=(\d+).*?n=(\d+)/(\d+)'
-    close_pattern = r'CLOSE host=::ffff:(\d+\.\d+\.\d+\.\d+) port=(\d+).*?fd=(\d+).*?time=([\d.]+)'
-    # Parse ISO timestamp from endlessh: 2025-10-14T16:17:13.280Z
-    timestamp_pattern = r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})\.\d+Z'
-
-    # Parse all events chronologically and build timeline
-    # First, collect all CLOSE events to know which connections are closed
-    closed_ports = set()
-    for line in output_6h.split('\n'):
-        close_match = re.search(close_pattern, line)
-        if close_match:
-            port = close_match.group(2)
-            closed_ports.add(port)
-
-    # Now parse ACCEPT events
-    all_durations = []
-    for line in output_6h.split('\n'):
-        match = re.search(accept_pattern, line)
-        if match:
-            ip = match.group(1)
-            port = match.group(2)
-            fd = match.group(3)
-            current_active = int(match.group(4))
+        for line in read_journal_lines('6 hours ago'):
+            # Cheap substring check skips JSON decoding for unrelated entries
+            if 'host=::ffff:' not in line:
+                continue
+            entry = json.loads(line)
+            message = entry.get('MESSAGE')
+            if not isinstance(message, str):
+                continue
+            event, fields = parse_endlessh_message(message)
+            if event is None:
+                continue
+
+            # Only IPv4 clients (mapped as ::ffff:a.b.c.d) are tracked
+            host = fields.get('host', '')
+            if not host.startswith('::ffff:'):
+                continue
+            ip = host[len('::ffff:'):]
+            port = fields.get('port', '')
 
             # Use ip:port as unique connection ID (port is unique per connection)
             conn_id = f"{ip}:{port}"
 
-            # Parse timestamp from log (UTC timestamp from endlessh)
-            ts_match = re.search(timestamp_pattern, line)
-            if ts_match:
-                # Parse ISO timestamp as UTC
-                timestamp_str = ts_match.group(1)
-                started_time = datetime.strptime(timestamp_str, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
-            else:
-                started_time = datetime.now(timezone.utc)
+            if event == 'CLOSE':
+                # Update the connection with duration (malformed entries without a time=20.003 number are skipped)
+                time_value = fields.get('time', '')
+                if conn_id in connections and time_value.replace('.', '', 1).isdecimal():
+                    duration = float(time_value)
+                    conn = connections[conn_id]
+                    conn['duration'] = duration
+                    conn['status'] = 'released'
+                    # Move released connections to hall_of_fame
+                    released[conn_id] = conn.copy()
+                continue
+
+            fd = fields.get('fd', '')
 
-            # Get GeoIP data (cached after first lookup)
-            if ip not in ip_locations:
-                get_geoip_data(ip)
+            # Journald receive time in microseconds since the epoch (UTC)
+            started_ts = int(entry['__REALTIME_TIMESTAMP']) / 1e6
 
-            geo = ip_locations.get(ip, {})
+            # Count new connections (the last 5 minutes are enough to catch up between parses)
+            if started_ts >= counter_cutoff_ts:
+                # Create unique ID for this log entry (timestamp + port)
+                log_id = f"{entry['__REALTIME_TIMESTAMP']}_{port}"
 
-            # Determine status: trapped if port not in closed_ports
-            if port in closed_ports:
-                status = 'released'
-            else:
-                status = 'trapped'
+                # Only count if we haven't seen this log entry before
+                if log_id not in seen_log_entries:
+                    seen_log_entries[log_id] = started_ts
+                    total_connections_counter += 1
+
+            # Get GeoIP data (resolved in the background, cached after first lookup)
+            geo = get_geoip_data(ip)
 
             # Store individual connection (will overwrite if same port appears multiple times)
-            individual_connections[conn_id] = {
+            # Every connection starts out trapped until its CLOSE event shows up
+            connections[conn_id] = {
                 'ip': ip,
                 'port': port,
                 'fd': fd,
-                'country': geo.get('country', 'Unknown').replace('"', ''),
-                'city': geo.get('city', 'Unknown').replace('"', ''),
+                'country': geo.get('country', 'Unknown'),
+                'city': geo.get('city', 'Unknown'),
                 'country_code': geo.get('country_code', 'XX'),
-                'started': started_time,
+                'started_ts': started_ts,
                 'duration': 0,
-                'status': status
+                'status': 'trapped'
             }
 
-            connections_per_ip[ip] += 1
-
-    # Second pass: Parse all CLOSE events to get durations
-    for line in output_6h.split('\n'):
-        close_match = re.search(close_pattern, line)
-        if close_match:
-            ip = close_match.group(1)
-            port = close_match.group(2)
-            fd = close_match.group(3)
-            duration = float(close_match.group(4))
-
-            # Use ip:port as unique connection ID
-            conn_id = f"{ip}:{port}"
+            ip_counts[ip] += 1
+    except subprocess.CalledProcessError:
+        return
 
-            # Update the connection with duration
-            if conn_id in individual_connections:
-                individual_connections[conn_id]['duration'] = duration
-                # Move released connections to hall_of_fame
-                hall_of_fame[conn_id] = individual_connections[conn_id].copy()
-                all_durations.append(duration)
+    individual_connections = connections
+    connections_per_ip = ip_counts
 
     # Separate trapped and released connections
     trapped_connections = {k: v for k, v in individual_connections.items() if v['status'] == 'trapped'}
 
-    # For trapped connections, calculate current duration
+    # For trapped connections, calculate current duration.
+    # Taken after journalctl finished, so entries logged while it streamed don't end up in the future.
+    now_ts = time.time()
     for conn_id, conn in trapped_connections.items():
-        conn['duration'] = (datetime.now(timezone.utc) - conn['started']).total_seconds()
-
-    # Deduplicate hall_of_fame: Keep only the longest duration per IP
-    # Group by IP and keep only the connection with max duration
-    ip_to_best_conn = {}
-    for conn_id, conn in hall_of_fame.items():
-        ip = conn['ip']
-        if ip not in ip_to_best_conn or conn['duration'] > ip_to_best_conn[ip][1]['duration']:
-            ip_to_best_conn[ip] = (conn_id, conn)
-
-    # Rebuild hall_of_fame with deduplicated connections
-    hall_of_fame = {conn_id: conn for conn_id, conn in ip_to_best_conn.values()}
-
-    # Keep only Top 100 released connections in hall_of_fame (by duration)
-    # Always trim to exactly 100 (or less if we have fewer)
-    if len(hall_of_fame) > 100:
-        # Sort by duration (descending) and keep top 100
-        sorted_hall = sorted(hall_of_fame.items(), key=lambda x: x[1]['duration'], reverse=True)
-        hall_of_fame = dict(sorted_hall[:100])
+        conn['duration'] = now_ts - conn['started_ts']
+
+    # Offer released connections to the Hall of Fame (Top 100 by duration, one per IP).
+    # Most of them were already offered by earlier parses and are rejected right away.
+    for conn_id, conn in released.items():
+        if add_to_hall_of_fame(conn_id, conn):
+            hall_of_fame_dirty = True
+
+    # Fill in locations of Hall of Fame entries released before their GeoIP lookup finished
+    for conn in hall_of_fame.values():
+        if conn['country_code'] == 'XX':
+            geo = get_geoip_data(conn['ip'])
+            if geo['country_code'] != 'XX':
+                conn.update(country=geo['country'], city=geo['city'], country_code=geo['country_code'])
+                hall_of_fame_dirty = True
 
     # Save Hall of Fame to persistent storage
     save_hall_of_fame()
@@ -247,8 +453,28 @@ def parse_endlessh_logs():
     display_connections = trapped_connections.copy()
     display_connections.update(hall_of_fame)
 
+    # Collect the duration column, the trapped count and the per-IP statistics
+    # (max and average trap duration) of DISPLAYED connections in one pass
+    all_durations = []
+    trapped_count = 0
+    ip_stats = {}
+    for conn in display_connections.values():
+        duration = conn['duration']
+        all_durations.append(duration)
+        if conn['status'] == 'trapped':
+            trapped_count += 1
+
+        stats = ip_stats.get(conn['ip'])
+        if stats is None:
+            ip_stats[conn['ip']] = [duration, duration, 1]
+        else:
+            if duration > stats[0]:
+                stats[0] = duration
+            stats[1] += duration
+            stats[2] += 1
+    ip_trap_durations = ip_stats
+
     # Calculate global max and average trap duration from DISPLAYED connections
-    all_durations = [conn['duration'] for conn in display_connections.values()]
     if all_durations:
         max_trap_duration = max(all_durations)
         avg_trap_duration = sum(all_durations) / len(all_durations)
@@ -256,141 +482,102 @@ def parse_endlessh_logs():
         max_trap_duration = 0
         avg_trap_duration = 0
 
-    # Calculate per-IP statistics (max and average trap duration)
-    ip_durations = defaultdict(list)
-    for conn_id, conn in display_connections.items():
-        ip_durations[conn['ip']].append(conn['duration'])
-
     # Active connections: count trapped connections in our data
     # This is more accurate than using endlessh's counter, which can be stale
-    active_connections = sum(1 for conn in display_connections.values() if conn['status'] == 'trapped')
+    active_connections = trapped_count
 
     # Store display_connections back to individual_connections for metric generation
     individual_connections = display_connections
 
-    # Parse 5min logs for new connections to add to counter
-    for line in output_5min.split('\n'):
-        match = re.search(accept_pattern, line)
-        if match:
-            # Create unique ID for this log entry (timestamp + FD)
-            ts_match = re.search(timestamp_pattern, line)
-            if ts_match:
-                fd = match.group(2)
-                log_id = f"{ts_match.group(1)}_{fd}"
-
-                # Only count if we haven't seen this log entry before
-                if log_id not in seen_log_entries:
-                    seen_log_entries.add(log_id)
-                    total_connections_counter += 1
-
-    # Clean up old seen_log_entries (keep only last 10 minutes worth)
-    # This prevents the set from growing forever
-    if len(seen_log_entries) > 1000:
-        # Keep only the most recent 500
-        seen_log_entries.clear()
-        # Will rebuild from next scrape
+    # Forget log entries older than the counting window; they are never counted again,
+    # so the guard against double counting stays intact while memory stays bounded
+    for log_id in [log_id for log_id, ts in seen_log_entries.items() if ts < counter_cutoff_ts]:
+        del seen_log_entries[log_id]
 
 def generate_metrics():
-    """Generate Prometheus metrics"""
+    """Generate Prometheus metrics (UTF-8 encoded exposition text)"""
     parse_endlessh_logs()
 
     metrics = []
+    # Bound once: the per-connection loops below append a line per row
+    append = metrics.append
 
     # Total connections counter (always increases, never resets - for rate calculations)
-    metrics.append('# HELP endlessh_total_connections_total Total SSH connections since exporter start')
-    metrics.append('# TYPE endlessh_total_connections_total counter')
-    metrics.append(f'endlessh_total_connections_total {total_connections_counter}')
+    append(HELP_TOTAL_CONNECTIONS_TOTAL)
+    append(f'endlessh_total_connections_total {total_connections_counter}'.encode())
 
     # Total connections gauge (last 60min - for display)
-    metrics.append('# HELP endlessh_total_connections Total SSH connections in last 60 minutes')
-    metrics.append('# TYPE endlessh_total_connections gauge')
-    metrics.append(f'endlessh_total_connections {len(individual_connections)}')
+    append(HELP_TOTAL_CONNECTIONS)
+    append(f'endlessh_total_connections {len(individual_connections)}'.encode())
 
     # Active connections
-    metrics.append('# HELP endlessh_active_connections Currently active SSH connections')
-    metrics.append('# TYPE endlessh_active_connections gauge')
-    metrics.append(f'endlessh_active_connections {active_connections}')
+    append(HELP_ACTIVE_CONNECTIONS)
+    append(f'endlessh_active_connections {active_connections}'.encode())
 
     # Global trap duration metrics
-    metrics.append('# HELP endlessh_max_trap_duration_seconds Maximum trap duration in seconds')
-    metrics.append('# TYPE endlessh_max_trap_duration_seconds gauge')
-    metrics.append(f'endlessh_max_trap_duration_seconds {max_trap_duration:.2f}')
+    append(HELP_MAX_TRAP_DURATION_SECONDS)
+    append(f'endlessh_max_trap_duration_seconds {max_trap_duration:.2f}'.encode())
 
-    metrics.append('# HELP endlessh_avg_trap_duration_seconds Average trap duration in seconds')
-    metrics.append('# TYPE endlessh_avg_trap_duration_seconds gauge')
-    metrics.append(f'endlessh_avg_trap_duration_seconds {avg_trap_duration:.2f}')
+    append(HELP_AVG_TRAP_DURATION_SECONDS)
+    append(f'endlessh_avg_trap_duration_seconds {avg_trap_duration:.2f}'.encode())
 
     # Individual connections - each connection gets its own metric
-    # Sort by: status (trapped first), then by duration (longest first)
-    def sort_key(item):
-        conn = item[1]
-        # trapped = 1, released = 0 (so trapped comes first when sorted desc)
-        status_priority = 1 if conn['status'] == 'trapped' else 0
-        # Return tuple: (status_priority desc, duration desc)
-        return (-status_priority, -conn['duration'])
-
-    metrics.append('# HELP endlessh_connection_info Individual connection information')
-    metrics.append('# TYPE endlessh_connection_info gauge')
+    append(HELP_CONNECTION_INFO)
 
-    # Sort connections and add sort_order field
-    sorted_connections = sorted(individual_connections.items(), key=sort_key)
+    # Sort by: status (trapped first, False < True), then by duration (longest first)
+    # and add sort_order field
+    sorted_connections = sorted(
+        individual_connections.values(),
+        key=lambda conn: (conn['status'] != 'trapped', -conn['duration'])
+    )
 
-    # Track IP addresses to assign group numbers for alternating row colors
+    # Assign group numbers for alternating row colors in order of first appearance,
+    # so all connections of an IP share the group number
     ip_group_map = {}  # ip -> group_number
-    current_group = 0
-    last_ip = None
 
-    for idx, (conn_id, conn) in enumerate(sorted_connections):
+    for idx, conn in enumerate(sorted_connections):
         # Format started time as readable string: "2025-10-14 18:32:29" (local time with date)
-        started_str = conn["started"].astimezone().strftime("%Y-%m-%d %H:%M:%S")
+        # (time.strftime on a struct_time is much cheaper per row than building a datetime)
+        started_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(conn['started_ts']))
 
         # Assign IP group number for alternating colors
-        current_ip = conn['ip']
-        if current_ip != last_ip:
-            # New IP group
-            if current_ip not in ip_group_map:
-                ip_group_map[current_ip] = current_group
-                current_group += 1
-            last_ip = current_ip
-
-        ip_group = ip_group_map[current_ip]
+        ip_group = ip_group_map.setdefault(conn['ip'], len(ip_group_map))
 
         # Add sort_order and ip_group as labels
         # ip_group allows alternating row colors (even/odd)
-        metrics.append(
+        append(
             f'endlessh_connection_info{{fd="{conn["fd"]}",ip="{conn["ip"]}",'
             f'port="{conn["port"]}",country="{conn["country"]}",city="{conn["city"]}",'
-            f'status="{conn["status"]}",started="{started_str}",sort_order="{idx}",ip_group="{ip_group}"}} {conn["duration"]:.2f}'
+            f'status="{conn["status"]}",started="{started_str}",sort_order="{idx}",ip_group="{ip_group}"}} {conn["duration"]:.2f}'.encode()
         )
 
-    # Calculate per-IP statistics for aggregated views
-    ip_durations = defaultdict(list)
-    for conn_id, conn in individual_connections.items():
-        ip_durations[conn['ip']].append(conn['duration'])
-
     # Connections per IP (aggregated for map view and Top Attackers table)
     for ip, count in connections_per_ip.items():
         geo = ip_locations.get(ip, {})
-        country = geo.get('country', 'Unknown').replace('"', '')
+        country = geo.get('country', 'Unknown')
         country_code = geo.get('country_code', 'XX')
-        city = geo.get('city', 'Unknown').replace('"', '')
+        city = geo.get('city', 'Unknown')
         lat = geo.get('lat', 0.0)
         lon = geo.get('lon', 0.0)
 
-        # Calculate max and avg trap duration for this IP
-        durations = ip_durations.get(ip, [0])
-        max_duration = max(durations) if durations else 0
-        avg_duration = sum(durations) / len(durations) if durations else 0
+        # Max and avg trap duration for this IP (aggregated while parsing)
+        stats = ip_trap_durations.get(ip)
+        if stats:
+            max_duration = stats[0]
+            avg_duration = stats[1] / stats[2]
+        else:
+            max_duration = 0
+            avg_duration = 0
 
-        metrics.append(
+        append(
             f'endlessh_connections_per_ip{{ip="{ip}",country="{country}",'
             f'country_code="{country_code}",city="{city}",'
             f'latitude="{lat}",longitude="{lon}",'
-            f'max_trap_duration="{max_duration:.2f}",avg_trap_duration="{avg_duration:.2f}"}} {count}'
+            f'max_trap_duration="{max_duration:.2f}",avg_trap_duration="{avg_duration:.2f}"}} {count}'.encode()
         )
 
     # Unique IPs
-    metrics.append(f'endlessh_unique_ips {len(connections_per_ip)}')
+    append(f'endlessh_unique_ips {len(connections_per_ip)}'.encode())
 
     # Connections per country
     countries = defaultdict(int)
@@ -400,19 +587,38 @@ def generate_metrics():
         countries[country] += connections_per_ip[ip]
 
     for country, count in countries.items():
-        country_safe = country.replace('"', '')
-        metrics.append(f'endlessh_connections_per_country{{country="{country_safe}"}} {count}')
+        append(f'endlessh_connections_per_country{{country="{country}"}} {count}'.encode())
+
+    # Empty last chunk gives the trailing newline without copying the joined result again
+    append(b'')
+    return b'\n'.join(metrics)
+
+def refresh_metrics():
+    """Parse the logs and replace the cached metrics"""
+    global metrics_cache
 
-    return '\n'.join(metrics) + '\n'
+    metrics = generate_metrics()
+    with metrics_lock:
+        metrics_cache = metrics
+
+def metrics_refresh_loop():
+    """Refresh the cached metrics periodically, independent of how often Prometheus scrapes"""
+    while True:
+        time.sleep(METRICS_REFRESH_INTERVAL)
+        try:
+            refresh_metrics()
+        except Exception as e:
+            print(f"Error refreshing metrics: {e}")
 
 class MetricsHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         if self.path == '/metrics':
-            metrics = generate_metrics()
+            with metrics_lock:
+                metrics = metrics_cache
             self.send_response(200)
             self.send_header('Content-type', 'text/plain; charset=utf-8')
             self.end_headers()
-            self.wfile.write(metrics.encode('utf-8'))
+            self.wfile.write(metrics)
         else:
             self.send_response(404)
             self.end_headers()
@@ -428,14 +634,27 @@ def main():
     # Load Hall of Fame from persistent storage
     load_hall_of_fame()
 
-    server = HTTPServer(('0.0.0.0', EXPORTER_PORT), MetricsHandler)
+    # Prefer the local GeoIP database over ip-api.com
+    open_geoip_database()
+
+    # Resolve GeoIP data for new IPs outside of the scrape
+    threading.Thread(target=geoip_worker, daemon=True).start()
+
+    # Parse the logs once before serving, then keep refreshing in the background
+    try:
+        refresh_metrics()
+    except Exception as e:
+        print(f"Error refreshing metrics: {e}")
+    threading.Thread(target=metrics_refresh_loop, daemon=True).start()
+
+    server = ThreadingHTTPServer(('0.0.0.0', EXPORTER_PORT), MetricsHandler)
 
     try:
         server.serve_forever()
     except KeyboardInterrupt:
+        # No final save here: the refresh thread already saves every change to the Hall of Fame,
+        # and saving from this thread could race with it
         print('\nShutting down...')
-        # Save Hall of Fame one last time before shutting down
-        save_hall_of_fame()
         server.shutdown()
 
 if __name__ == '__main__':